@@ -1,21 +1,26 @@
 use std::{
     borrow::Cow,
-    collections::HashMap,
-    fmt, fs, io,
+    cell::RefCell,
+    collections::{HashMap, HashSet},
+    fmt::{self, Write as _},
+    fs,
+    io::{self, Read, Write},
     path::{Path, PathBuf},
     process::ExitCode,
     str::FromStr,
+    sync::LazyLock,
     thread,
+    time::SystemTime,
 };
 
 use clap::{Parser, Subcommand};
 use color_eyre::eyre::{self, Context};
 use ignore::WalkBuilder;
-use rayon::iter::{IntoParallelIterator, ParallelIterator};
+use rayon::iter::{ParallelBridge, ParallelIterator};
 use serde::{Deserialize, Serialize};
 use skim::prelude::*;
 use tracing_subscriber::EnvFilter;
-use tree_sitter::Node;
+use tree_sitter::{Query, QueryCursor};
 
 #[derive(Debug, Clone, Copy)]
 enum CacheClearOption {
@@ -44,6 +49,18 @@ struct SearchArgs {
     /// Print results rather than using fuzzy find
     #[arg(short, long)]
     no_fuzzy_selection: bool,
+
+    /// Parse files with tree-sitter rather than the line based scanner
+    #[arg(long)]
+    strict: bool,
+
+    /// Parse every file rather than reusing tests found in previous runs
+    #[arg(long)]
+    no_cache: bool,
+
+    /// Number of threads each to find and to parse files with [default: number of CPUs]
+    #[arg(short = 'j', long)]
+    threads: Option<usize>,
 }
 
 #[derive(Subcommand, Debug, Clone)]
@@ -84,6 +101,10 @@ enum StateCommand {
 
 #[derive(Debug, Parser)]
 struct Args {
+    /// Directory to store state and cached tests in
+    #[arg(long, global = true)]
+    cache_dir: Option<PathBuf>,
+
     #[command(flatten)]
     search: Option<SearchArgs>,
 
@@ -163,8 +184,8 @@ impl State {
         let cache_file = cache_root.join("cache.json");
 
         let persisted_state = if cache_file.is_file() {
-            let mut f = std::fs::File::open(&cache_file).wrap_err("opening existing cache file")?;
-            serde_json::from_reader(&mut f).wrap_err("decoding existing cache file")?
+            let contents = fs::read(&cache_file).wrap_err("reading existing cache file")?;
+            serde_json::from_slice(&contents).wrap_err("decoding existing cache file")?
         } else {
             PersistedState::default()
         };
@@ -195,10 +216,7 @@ impl State {
     }
 
     fn flush(&self) -> eyre::Result<()> {
-        let mut outfile =
-            std::fs::File::create(&self.cache_file).wrap_err("creating cache file")?;
-        serde_json::to_writer(&mut outfile, &self.persisted)
-            .wrap_err("writing state to cache file")?;
+        write_json(&self.cache_file, &self.persisted).wrap_err("writing state to cache file")?;
         Ok(())
     }
 
@@ -209,19 +227,183 @@ impl State {
     }
 }
 
-fn find_test_files(root: impl AsRef<Path>, chan: Sender<PathBuf>) -> eyre::Result<()> {
-    WalkBuilder::new(root).build_parallel().run(|| {
+/// Tests previously found in a file, valid while the file is unchanged
+#[derive(Serialize, Deserialize)]
+struct CachedFile {
+    modified: SystemTime,
+    size: u64,
+    /// Whether the tests were found with the tree-sitter parser
+    strict: bool,
+    tests: FileTests,
+}
+
+/// Version of the test cache, bump whenever its format or the tests either parser finds in a
+/// file change, so that stale entries are not reused
+const TEST_CACHE_VERSION: u32 = 3;
+
+#[derive(Serialize, Deserialize)]
+struct PersistedTestCache {
+    /// Version the cache was written with, caches written before versioning have none
+    #[serde(default)]
+    version: u32,
+
+    /// Mapping from absolute file path to the tests found in it
+    #[serde(default)]
+    files: HashMap<PathBuf, CachedFile>,
+}
+
+impl Default for PersistedTestCache {
+    fn default() -> Self {
+        Self {
+            version: TEST_CACHE_VERSION,
+            files: HashMap::new(),
+        }
+    }
+}
+
+/// Persistent cache of the tests found in each file, so unchanged files are not parsed again
+struct TestCache {
+    persisted: PersistedTestCache,
+    cache_file: PathBuf,
+}
+
+impl TestCache {
+    fn new(cache_root: impl AsRef<Path>) -> eyre::Result<Self> {
+        let cache_root = cache_root.as_ref();
+        std::fs::create_dir_all(cache_root).wrap_err("creating cache dir")?;
+        let cache_file = cache_root.join("tests.json");
+
+        let persisted = if cache_file.is_file() {
+            let contents = fs::read(&cache_file).wrap_err("reading existing test cache")?;
+            // the cache can always be rebuilt, so start again rather than failing
+            match serde_json::from_slice::<PersistedTestCache>(&contents) {
+                Ok(persisted) if persisted.version == TEST_CACHE_VERSION => persisted,
+                Ok(persisted) => {
+                    tracing::debug!(
+                        version = persisted.version,
+                        "discarding outdated test cache"
+                    );
+                    PersistedTestCache::default()
+                }
+                Err(e) => {
+                    tracing::warn!(error = %e, "discarding invalid test cache");
+                    PersistedTestCache::default()
+                }
+            }
+        } else {
+            PersistedTestCache::default()
+        };
+
+        Ok(Self {
+            persisted,
+            cache_file,
+        })
+    }
+
+    fn get(
+        &self,
+        path: &Path,
+        modified: SystemTime,
+        size: u64,
+        strict: bool,
+    ) -> Option<&CachedFile> {
+        self.persisted
+            .files
+            .get(path)
+            .filter(|f| f.modified == modified && f.size == size && f.strict == strict)
+    }
+
+    /// Record the files visited by a search of `roots`, with the new entry for each file that
+    /// had to be parsed
+    ///
+    /// Entries for other files under `roots` are removed, so deleted and renamed files do not
+    /// stay in the cache. Files whose path is not valid UTF-8 are ignored. Returns whether the
+    /// cache changed.
+    fn update(
+        &mut self,
+        roots: &[PathBuf],
+        visited: impl IntoIterator<Item = (PathBuf, Option<CachedFile>)>,
+    ) -> bool {
+        let files = &mut self.persisted.files;
+        let mut changed = false;
+
+        let mut seen = HashSet::new();
+        for (path, entry) in visited {
+            // paths that are not valid UTF-8 cannot be written as JSON keys, and one would
+            // stop the whole cache being written
+            if path.to_str().is_none() {
+                continue;
+            }
+            if let Some(entry) = entry {
+                files.insert(path.clone(), entry);
+                changed = true;
+            }
+            seen.insert(path);
+        }
+
+        let before = files.len();
+        files.retain(|path, _| {
+            seen.contains(path) || !roots.iter().any(|root| path.starts_with(root))
+        });
+        changed || files.len() != before
+    }
+
+    fn flush(&self) -> eyre::Result<()> {
+        write_json(&self.cache_file, &self.persisted).wrap_err("writing tests to test cache")?;
+        Ok(())
+    }
+}
+
+/// Write a value to a JSON file, via a temporary file so concurrent runs never see a partial
+/// write
+fn write_json(path: &Path, value: &impl Serialize) -> eyre::Result<()> {
+    let temp_file = path.with_extension(format!("json.{}", std::process::id()));
+    let write = || -> eyre::Result<()> {
+        let mut outfile =
+            io::BufWriter::new(fs::File::create(&temp_file).wrap_err("creating temporary file")?);
+        serde_json::to_writer(&mut outfile, value).wrap_err("serializing to JSON")?;
+        outfile.flush().wrap_err("flushing temporary file")?;
+        fs::rename(&temp_file, path).wrap_err("replacing file")?;
+        Ok(())
+    };
+    write().inspect_err(|_| {
+        // do not leave a partial file behind for every failed write
+        let _ = fs::remove_file(&temp_file);
+    })
+}
+
+fn find_test_files(
+    roots: &[PathBuf],
+    threads: Option<usize>,
+    chan: Sender<PathBuf>,
+) -> eyre::Result<()> {
+    let Some((first, rest)) = roots.split_first() else {
+        return Ok(());
+    };
+    // walk every root with the same threads, so the thread count holds however many roots
+    // there are
+    let mut walker = WalkBuilder::new(first);
+    for root in rest {
+        walker.add(root);
+    }
+    walker.threads(threads.unwrap_or(0));
+    walker.build_parallel().run(|| {
         Box::new(|path| {
             if let Ok(entry) = path {
-                let path = entry.path();
-                if path.is_file()
-                    && path
-                        .file_name()
-                        .and_then(|filename| filename.to_str())
-                        .map(|filename| filename.starts_with("test_") && filename.ends_with(".py"))
-                        .unwrap_or_default()
-                {
-                    let _ = chan.send(path.to_path_buf());
+                // check the name before the file type, and take the file type from the
+                // directory listing rather than stat-ing every entry
+                let is_test_file = entry
+                    .file_name()
+                    .to_str()
+                    .map(|filename| filename.starts_with("test_") && filename.ends_with(".py"))
+                    .unwrap_or_default()
+                    && match entry.file_type() {
+                        Some(file_type) if file_type.is_symlink() => entry.path().is_file(),
+                        Some(file_type) => file_type.is_file(),
+                        None => false,
+                    };
+                if is_test_file {
+                    let _ = chan.send(entry.into_path());
                 }
             }
             ignore::WalkState::Continue
@@ -230,12 +412,25 @@ fn find_test_files(root: impl AsRef<Path>, chan: Sender<PathBuf>) -> eyre::Resul
     Ok(())
 }
 
-fn perform_search(args: SearchArgs, mut state: State) -> eyre::Result<ExitCode> {
+fn perform_search(args: SearchArgs, mut state: State, cache_root: &Path) -> eyre::Result<ExitCode> {
     let SearchArgs {
         root,
         no_fuzzy_selection,
+        strict,
+        no_cache,
+        threads,
     } = args;
-    let (files_tx, files_rx) = unbounded();
+
+    if let Some(threads) = threads {
+        rayon::ThreadPoolBuilder::new()
+            .num_threads(threads)
+            .build_global()
+            .wrap_err("configuring parsing threads")?;
+    }
+
+    // only let the directory walkers get a little ahead of parsing, so paths found but not
+    // yet parsed do not pile up in memory
+    let (files_tx, files_rx) = bounded(4 * rayon::current_num_threads());
 
     // check that some files were passed, otherwise default to the current working directory
     let search_roots = if root.is_empty() {
@@ -244,51 +439,93 @@ fn perform_search(args: SearchArgs, mut state: State) -> eyre::Result<ExitCode>
     } else {
         root
     };
+    // cache entries are keyed by absolute path, so the roots must be too
+    let cache_roots = search_roots
+        .iter()
+        .map(std::path::absolute)
+        .collect::<io::Result<Vec<_>>>()
+        .wrap_err("resolving absolute search roots")?;
+
+    tracing::debug!(roots = ?search_roots, "listing files");
+    let file_handle = thread::spawn(move || {
+        if let Err(e) = find_test_files(&search_roots, threads, files_tx) {
+            tracing::warn!(error = %e, "finding test files");
+        }
+    });
 
-    let mut file_handles = Vec::new();
-    for path in search_roots {
-        let span = tracing::debug_span!("", path = %path.display());
-        let _guard = span.enter();
-
-        tracing::debug!("listing files");
+    // parse files as they are found rather than waiting for every directory to be listed
+    let Ok(first_file) = files_rx.recv() else {
+        eyre::bail!("No compatible test files found");
+    };
+    let files = std::iter::once(first_file).chain(files_rx);
 
-        let files_tx = files_tx.clone();
-        file_handles.push(thread::spawn(move || {
-            if let Err(e) = find_test_files(&path, files_tx) {
-                tracing::warn!(error = %e, path = %path.display(), "finding test files");
-            }
-        }));
-    }
-    drop(files_tx);
+    let mut cache = if no_cache {
+        None
+    } else {
+        Some(TestCache::new(cache_root).wrap_err("loading test cache")?)
+    };
 
-    for handle in file_handles {
-        let _ = handle.join();
-    }
+    let (test_sender, test_receiver) = if no_fuzzy_selection {
+        let (lines_tx, lines_rx) = unbounded();
+        (TestSender::Lines(lines_tx), TestReceiver::Lines(lines_rx))
+    } else {
+        let (test_tx, test_rx) = unbounded();
+        (TestSender::Items(test_tx), TestReceiver::Items(test_rx))
+    };
 
-    let files: Vec<_> = files_rx.into_iter().collect();
-    if files.is_empty() {
-        eyre::bail!("No compatible test files found");
-    }
+    // parse in the background so tests are shown as soon as they are found
+    let parse_handle = thread::spawn(move || {
+        let visited: Vec<_> = files
+            .par_bridge()
+            .map_with(test_sender, |sender, path| {
+                match search_file(sender, &path, strict, cache.as_ref()) {
+                    Ok(visited) => visited,
+                    Err(e) => {
+                        tracing::warn!(error = %e, path = %path.display(), "error parsing file");
+                        None
+                    }
+                }
+            })
+            .flatten()
+            .collect();
 
-    tracing::debug!(n = files.len(), "finished collecting files");
+        let _ = file_handle.join();
 
-    let (test_tx, test_rx) = unbounded();
-    files
-        .into_par_iter()
-        .for_each_with(test_tx, |sender, path| {
-            if let Err(e) = parse_file(sender, &path) {
-                tracing::warn!(error = %e, path = %path.display(), "error parsing file");
+        if let Some(cache) = cache.as_mut() {
+            if cache.update(&cache_roots, visited) {
+                tracing::debug!("updating test cache");
+                if let Err(e) = cache.flush() {
+                    tracing::warn!(error = %e, "writing test cache");
+                }
             }
-        });
-
-    if no_fuzzy_selection {
-        for test in test_rx {
-            println!("{}", test.text());
         }
+    });
 
-        return Ok(ExitCode::SUCCESS);
+    let result = match test_receiver {
+        TestReceiver::Lines(lines_rx) => print_tests(lines_rx),
+        TestReceiver::Items(test_rx) => select_test(test_rx, &mut state),
+    };
+
+    // let parsing finish even if a test was selected early, so the cache is complete
+    let _ = parse_handle.join();
+
+    result
+}
+
+fn print_tests(lines_rx: Receiver<String>) -> eyre::Result<ExitCode> {
+    // lock stdout once and write in large chunks rather than once per file
+    let mut stdout = io::BufWriter::with_capacity(64 * 1024, io::stdout().lock());
+    for lines in lines_rx {
+        stdout
+            .write_all(lines.as_bytes())
+            .wrap_err("writing tests to stdout")?;
     }
+    stdout.flush().wrap_err("flushing stdout")?;
 
+    Ok(ExitCode::SUCCESS)
+}
+
+fn select_test(test_rx: Receiver<Arc<dyn SkimItem>>, state: &mut State) -> eyre::Result<ExitCode> {
     // perform fuzzy search
     let skim_options = SkimOptionsBuilder::default()
         .multi(false)
@@ -329,15 +566,18 @@ fn main() -> eyre::Result<ExitCode> {
 
     let args = Args::parse();
 
-    let cache_root = dirs::cache_dir()
-        .map(|p| p.join("testsearch"))
-        .ok_or_else(|| eyre::eyre!("locating cache dir on system"))?;
+    let cache_root = match args.cache_dir {
+        Some(cache_dir) => cache_dir,
+        None => dirs::cache_dir()
+            .map(|p| p.join("testsearch"))
+            .ok_or_else(|| eyre::eyre!("locating cache dir on system"))?,
+    };
     tracing::debug!(cache_root = %cache_root.display(), "using cache root dir");
-    let mut state = State::new(cache_root).wrap_err("constructing persistent state")?;
+    let mut state = State::new(&cache_root).wrap_err("constructing persistent state")?;
     state.migrate_settings().wrap_err("migrating settings")?;
 
     match args.command {
-        Some(Command::Search(args)) => perform_search(args, state),
+        Some(Command::Search(args)) => perform_search(args, state, &cache_root),
         Some(Command::State { state_command }) => match state_command {
             StateCommand::Clear { all } => {
                 let cache_clear_option = if all {
@@ -430,8 +670,8 @@ fn main() -> eyre::Result<ExitCode> {
         None => {
             // Assume search command
             match args.search {
-                Some(args) => perform_search(args, state),
-                None => perform_search(SearchArgs::default(), state),
+                Some(args) => perform_search(args, state, &cache_root),
+                None => perform_search(SearchArgs::default(), state, &cache_root),
             }
         }
     }
@@ -447,208 +687,805 @@ impl SkimItem for TestHistoryEntry {
     }
 }
 
-struct Visitor<'s> {
-    filename: &'s Path,
-    sender: &'s mut skim::prelude::Sender<Arc<dyn SkimItem>>,
-    bytes: Vec<u8>,
+thread_local! {
+    /// Each parsing thread configures its own parser once and reuses it for every file
+    static PARSER: RefCell<tree_sitter::Parser> = RefCell::new(tree_sitter::Parser::new());
+
+    /// Buffer each parsing thread reads files into, rather than allocating one per file
+    static SOURCE: RefCell<Vec<u8>> = const { RefCell::new(Vec::new()) };
 }
 
-impl<'s> Visitor<'s> {
-    pub fn new(
-        filename: &'s Path,
-        sender: &'s mut skim::prelude::Sender<Arc<dyn SkimItem>>,
-    ) -> eyre::Result<Self> {
-        let bytes = fs::read(filename).wrap_err("reading file")?;
-        Ok(Self {
-            filename,
-            sender,
+/// Matches functions defined at module level or directly inside a class, with or without
+/// decorators. Names are filtered after matching.
+const TEST_QUERY_SOURCE: &str = r#"
+(module
+  [
+    (function_definition name: (identifier) @name)
+    (decorated_definition definition: (function_definition name: (identifier) @name))
+  ])
+
+(module
+  [
+    (class_definition
+      name: (identifier) @class
+      body: (block
+        [
+          (function_definition name: (identifier) @name)
+          (decorated_definition definition: (function_definition name: (identifier) @name))
+        ]))
+    (decorated_definition
+      definition: (class_definition
+        name: (identifier) @class
+        body: (block
+          [
+            (function_definition name: (identifier) @name)
+            (decorated_definition definition: (function_definition name: (identifier) @name))
+          ])))
+  ])
+"#;
+
+struct TestQuery {
+    query: Query,
+    /// capture index of the function name
+    name: u32,
+    /// capture index of the enclosing class name
+    class: u32,
+}
+
+/// Compiled once and shared between all parsing threads
+static TEST_QUERY: LazyLock<TestQuery> = LazyLock::new(|| {
+    let query = Query::new(&tree_sitter_python::LANGUAGE.into(), TEST_QUERY_SOURCE)
+        .expect("invalid test query");
+    TestQuery {
+        name: query
+            .capture_index_for_name("name")
+            .expect("no name capture in test query"),
+        class: query
+            .capture_index_for_name("class")
+            .expect("no class capture in test query"),
+        query,
+    }
+});
+
+/// Test names found in a file, grouped by enclosing class name so that each class name is
+/// stored once
+type FileTests = Vec<(Option<String>, Vec<String>)>;
+
+struct Visitor<'b> {
+    bytes: &'b [u8],
+    /// Tests found so far
+    tests: FileTests,
+}
+
+impl<'b> Visitor<'b> {
+    pub fn new(bytes: &'b [u8]) -> Self {
+        Self {
             bytes,
-        })
+            tests: Vec::new(),
+        }
     }
 
-    fn visit(&mut self) -> eyre::Result<()> {
-        let language = tree_sitter_python::LANGUAGE;
-        let mut parser = tree_sitter::Parser::new();
-        parser
-            .set_language(&language.into())
-            .wrap_err("configuring language")?;
-
-        let tree = parser
-            .parse(&self.bytes, None)
-            .ok_or_else(|| eyre::eyre!("parsing file"))?;
-
-        let root = tree.root_node();
-
-        let mut cursor = root.walk();
-        for child in root.children(&mut cursor) {
-            match child.kind() {
-                "decorated_definition" => self.handle_decorated_definition(child, None)?,
-                "class_definition" => self.handle_class_definition(child)?,
-                "function_definition" => self.handle_function_definition(child, None)?,
-                "import_statement"
-                | "import_from_statement"
-                | "expression_statement"
-                | "comment"
-                | "if_statement"
-                | "try_statement"
-                | "assert_statement" => continue,
-                kind => todo!("{kind}"),
+    /// Find tests by scanning the source line by line, tracking indentation to pair methods
+    /// with their enclosing `Test*` class.
+    ///
+    /// This avoids building a full syntax tree. Only brackets, strings and comments are
+    /// tracked, enough to skip the continuation lines of statements spanning several lines
+    /// such as class headers and function signatures. Use [`Visitor::visit`] for an exact
+    /// parse.
+    fn scan(&mut self) -> eyre::Result<()> {
+        let bytes = self.bytes;
+
+        // name of the enclosing test class, and the indentation of its body once known
+        let mut class: Option<(String, Option<usize>)> = None;
+        let mut line_state = LineState::default();
+
+        for line in bytes.split(|&b| b == b'\n') {
+            let is_continuation = line_state.is_continuation();
+            line_state.advance(line);
+            if is_continuation {
+                continue;
             }
-        }
 
-        Ok(())
-    }
+            let content = line.trim_ascii_start();
+            if content.is_empty() || content[0] == b'#' {
+                continue;
+            }
+            let indent = line.len() - content.len();
 
-    fn handle_decorated_definition(
-        &mut self,
-        node: Node,
-        class_name: Option<String>,
-    ) -> eyre::Result<()> {
-        let mut cursor = node.walk();
-        for child in node.children(&mut cursor) {
-            match child.kind() {
-                "function_definition" => {
-                    self.handle_function_definition(child, class_name.clone())?
+            if indent == 0 {
+                class = None;
+                if let Some(class_name) = strip_keyword(content, b"class")
+                    .map(identifier)
+                    .filter(|name| name.starts_with(b"Test"))
+                {
+                    let class_name =
+                        std::str::from_utf8(class_name).wrap_err("reading class name")?;
+                    class = Some((class_name.to_string(), None));
+                    continue;
+                }
+            } else if let Some((_, body_indent)) = class.as_mut() {
+                if *body_indent.get_or_insert(indent) != indent {
+                    continue;
                 }
-                "class_definition" => self.handle_class_definition(child)?,
-                "decorator" | "comment" => continue,
-                kind => todo!("{kind}"),
+            } else {
+                continue;
             }
+
+            let content = strip_keyword(content, b"async").unwrap_or(content);
+            let Some(identifier) = strip_keyword(content, b"def").map(identifier) else {
+                continue;
+            };
+            if !identifier.starts_with(b"test_") {
+                continue;
+            }
+
+            let identifier = std::str::from_utf8(identifier)
+                .wrap_err("reading bytes for function identifier")?;
+            let class_name = class.as_ref().map(|(name, _)| name.as_str());
+            self.emit(identifier, class_name);
         }
+
         Ok(())
     }
 
-    fn handle_class_definition(&mut self, node: Node) -> eyre::Result<()> {
-        // TODO: nested classes?
-        let Some(class_name_node) = node.child(1) else {
-            eyre::bail!("no class name found");
-        };
+    fn visit(&mut self) -> eyre::Result<()> {
+        let tree = PARSER.with_borrow_mut(|parser| -> eyre::Result<_> {
+            if parser.language().is_none() {
+                let language = tree_sitter_python::LANGUAGE;
+                parser
+                    .set_language(&language.into())
+                    .wrap_err("configuring language")?;
+            }
 
-        if class_name_node.kind() != "identifier" {
-            eyre::bail!(
-                "invalid class name node type, expected 'identifier', got '{}'",
-                class_name_node.kind()
-            );
-        }
+            parser
+                .parse(self.bytes, None)
+                .ok_or_else(|| eyre::eyre!("parsing file"))
+        })?;
+
+        let bytes = self.bytes;
+        let mut cursor = QueryCursor::new();
+        for query_match in cursor.matches(&TEST_QUERY.query, tree.root_node(), bytes) {
+            let mut identifier = None;
+            let mut class_name = None;
+            for capture in query_match.captures {
+                // only check names that pass the filters below are valid UTF-8
+                let text = &bytes[capture.node.byte_range()];
+                if capture.index == TEST_QUERY.name {
+                    identifier = Some(text);
+                } else if capture.index == TEST_QUERY.class {
+                    class_name = Some(text);
+                }
+            }
 
-        // TODO: can we prevent this clone?
-        let bytes = self.bytes.clone();
-        let class_name = class_name_node
-            .utf8_text(&bytes)
-            .wrap_err("reading class name")?;
+            let Some(identifier) = identifier.filter(|name| name.starts_with(b"test_")) else {
+                continue;
+            };
+            if class_name.is_some_and(|name| !name.starts_with(b"Test")) {
+                continue;
+            }
 
-        if !class_name.starts_with("Test") {
-            // stop parsing
-            return Ok(());
-        }
+            let identifier = std::str::from_utf8(identifier)
+                .wrap_err("reading bytes for function identifier")?;
+            let class_name = class_name
+                .map(std::str::from_utf8)
+                .transpose()
+                .wrap_err("reading class name")?;
 
-        let mut cursor = node.walk();
-        for child in node.children(&mut cursor).skip(2) {
-            match child.kind() {
-                "block" => self.handle_class_block(child, Some(class_name.to_string()))?,
-                ":" | "argument_list" | "comment" => continue,
-                kind => todo!("{kind}"),
-            }
+            self.emit(identifier, class_name);
         }
 
         Ok(())
     }
 
-    fn handle_class_block(&mut self, node: Node, class_name: Option<String>) -> eyre::Result<()> {
-        let mut cursor = node.walk();
-        for child in node.children(&mut cursor) {
-            match child.kind() {
-                "decorated_definition" => {
-                    self.handle_decorated_definition(child, class_name.clone())?
-                }
-                "function_definition" => {
-                    self.handle_function_definition(child, class_name.clone())?
-                }
-                "expression_statement" | "comment" | "pass_statement" => continue,
-                kind => todo!("{kind} {}", node.parent().unwrap().utf8_text(&self.bytes)?),
+    fn emit(&mut self, test_name: &str, class_name: Option<&str>) {
+        match self.tests.last_mut() {
+            Some((last_class_name, names)) if last_class_name.as_deref() == class_name => {
+                names.push(test_name.to_string());
             }
+            _ => self
+                .tests
+                .push((class_name.map(str::to_string), vec![test_name.to_string()])),
         }
-        Ok(())
     }
+}
 
-    fn handle_function_definition(
-        &mut self,
-        node: Node,
-        class_name: Option<String>,
-    ) -> eyre::Result<()> {
-        let Some(identifier_node) = node.child(1) else {
-            eyre::bail!("no identifier node found");
-        };
+/// Find the tests in a file
+fn parse_file(path: &Path, strict: bool) -> eyre::Result<FileTests> {
+    SOURCE.with_borrow_mut(|bytes| -> eyre::Result<_> {
+        bytes.clear();
+        fs::File::open(path)
+            .and_then(|mut f| f.read_to_end(bytes))
+            .wrap_err("reading file")?;
+
+        // skip parsing files that cannot contain any tests
+        if !may_contain_tests(bytes) {
+            return Ok(Vec::new());
+        }
 
-        let bytes = self.bytes.clone();
-        let identifier = identifier_node
-            .utf8_text(&bytes)
-            .wrap_err("reading bytes for function identifier")?;
+        let mut visitor = Visitor::new(bytes);
+        if strict {
+            visitor.visit().wrap_err("parsing file")?;
+        } else {
+            visitor.scan().wrap_err("scanning file")?;
+        }
+        Ok(visitor.tests)
+    })
+}
 
-        if !identifier.starts_with("test_") {
-            return Ok(());
+/// Whether the source contains `def`, whitespace and then `test_`, as every test definition
+/// does whichever whitespace separates them
+fn may_contain_tests(bytes: &[u8]) -> bool {
+    memchr::memmem::find_iter(bytes, b"test_").any(|start| {
+        let before = bytes[..start].trim_ascii_end();
+        before.len() < start && before.ends_with(b"def")
+    })
+}
+
+/// Send the tests found in a file, reusing the cached tests if the file is unchanged
+///
+/// Returns the cache key of the file when caching, with the new cache entry if the file had to
+/// be parsed. Files whose path is not valid UTF-8 are not cached.
+fn search_file(
+    sender: &TestSender,
+    path: &Path,
+    strict: bool,
+    cache: Option<&TestCache>,
+) -> eyre::Result<Option<(PathBuf, Option<CachedFile>)>> {
+    let cache_key = match cache {
+        Some(cache) => {
+            let key = std::path::absolute(path).wrap_err("resolving absolute path")?;
+            // the cache is stored as JSON, which cannot represent other paths
+            key.to_str().is_some().then_some((cache, key))
         }
+        None => None,
+    };
+    let Some((cache, key)) = cache_key else {
+        let tests = parse_file(path, strict)?;
+        sender.send(path, &tests);
+        return Ok(None);
+    };
 
-        self.emit(identifier, class_name)
-            .wrap_err("sending test case")?;
+    let metadata = fs::metadata(path).wrap_err("reading file metadata")?;
+    let modified = metadata
+        .modified()
+        .wrap_err("reading file modification time")?;
+    if let Some(cached) = cache.get(&key, modified, metadata.len(), strict) {
+        sender.send(path, &cached.tests);
+        return Ok(Some((key, None)));
+    }
 
-        Ok(())
+    let tests = parse_file(path, strict)?;
+    sender.send(path, &tests);
+    Ok(Some((
+        key,
+        Some(CachedFile {
+            modified,
+            size: metadata.len(),
+            strict,
+            tests,
+        }),
+    )))
+}
+
+/// Where the tests found in each file are sent
+#[derive(Clone)]
+enum TestSender {
+    /// One item per test, for the fuzzy finder
+    Items(Sender<Arc<dyn SkimItem>>),
+    /// One block of newline terminated test ids per file, for printing
+    Lines(Sender<String>),
+}
+
+impl TestSender {
+    fn send(&self, path: &Path, tests: &FileTests) {
+        // a failed send means the receiver has gone away, e.g. because a test has already been
+        // selected, so there is nothing left to do
+        match self {
+            Self::Items(sender) => {
+                for (class_name, names) in tests {
+                    for name in names {
+                        let test_case = TestCase::new(name, path, class_name.as_deref());
+                        if sender.send(Arc::new(test_case)).is_err() {
+                            return;
+                        }
+                    }
+                }
+            }
+            Self::Lines(sender) => {
+                if tests.is_empty() {
+                    return;
+                }
+                let mut lines = String::new();
+                for (class_name, names) in tests {
+                    for name in names {
+                        write_test_id(&mut lines, path, class_name.as_deref(), name);
+                        lines.push('\n');
+                    }
+                }
+                let _ = sender.send(lines);
+            }
+        }
     }
+}
 
-    fn emit(
-        &mut self,
-        test_name: impl Into<String>,
-        class_name: Option<String>,
-    ) -> eyre::Result<()> {
-        let test_case = TestCase {
-            name: test_name.into(),
-            file: self.filename.to_path_buf(),
-            class_name,
-        };
+enum TestReceiver {
+    Items(Receiver<Arc<dyn SkimItem>>),
+    Lines(Receiver<String>),
+}
 
-        let send_item = Arc::new(test_case);
+/// Lexical state carried from one line of source to the next while scanning
+#[derive(Default)]
+struct LineState {
+    /// Number of brackets left open
+    depth: usize,
+    /// Quote character of a string left open, and whether it is triple quoted
+    string: Option<(u8, bool)>,
+    /// Whether the line ended with a backslash
+    backslash: bool,
+}
 
-        self.sender
-            .send(send_item)
-            .wrap_err("sending test case to closed receiver")?;
+impl LineState {
+    /// Whether the next line continues a statement started on an earlier line
+    fn is_continuation(&self) -> bool {
+        self.depth > 0 || self.string.is_some() || self.backslash
+    }
 
-        Ok(())
+    /// Update the state to the end of `line`
+    fn advance(&mut self, line: &[u8]) {
+        let mut string = self.string;
+        self.backslash = false;
+        // whether a backslash at the very end of the line continues a short string
+        let mut escaped_newline = false;
+
+        let mut i = 0;
+        while i < line.len() {
+            let b = line[i];
+            match string {
+                Some(_) if b == b'\\' => {
+                    escaped_newline = matches!(&line[i + 1..], b"" | b"\r");
+                    i += 1;
+                }
+                Some((quote, triple)) if b == quote => {
+                    if !triple {
+                        string = None;
+                    } else if line[i..].starts_with(&[quote; 3]) {
+                        i += 2;
+                        string = None;
+                    }
+                }
+                Some(_) => {}
+                None => match b {
+                    b'"' | b'\'' => {
+                        let triple = line[i..].starts_with(&[b; 3]);
+                        if triple {
+                            i += 2;
+                        }
+                        string = Some((b, triple));
+                    }
+                    b'#' => break,
+                    b'(' | b'[' | b'{' => self.depth += 1,
+                    b')' | b']' | b'}' => self.depth = self.depth.saturating_sub(1),
+                    // outside of strings a backslash can only join the next line
+                    b'\\' => self.backslash = true,
+                    _ => {}
+                },
+            }
+            i += 1;
+        }
+
+        // short strings only span lines when the newline is escaped
+        self.string = string.filter(|&(_, triple)| triple || escaped_newline);
     }
 }
 
-fn parse_file(
-    sender: &mut skim::prelude::Sender<Arc<dyn SkimItem>>,
-    path: &Path,
-) -> eyre::Result<()> {
-    let mut visitor = Visitor::new(path, sender).wrap_err("creating visitor")?;
-    visitor.visit().wrap_err("parsing file")?;
-    Ok(())
+/// Strip a leading keyword and the whitespace following it
+fn strip_keyword<'a>(line: &'a [u8], keyword: &[u8]) -> Option<&'a [u8]> {
+    let rest = line.strip_prefix(keyword)?;
+    let trimmed = rest.trim_ascii_start();
+    (trimmed.len() < rest.len()).then_some(trimmed)
+}
+
+/// Take the leading Python identifier from the line
+///
+/// Any non-ASCII byte is taken as part of the identifier, since Python allows Unicode
+/// identifiers. The caller checks the result is valid UTF-8.
+fn identifier(line: &[u8]) -> &[u8] {
+    let end = line
+        .iter()
+        .position(|&b| !(b.is_ascii_alphanumeric() || b == b'_' || !b.is_ascii()))
+        .unwrap_or(line.len());
+    &line[..end]
 }
 
+/// A test case, formatted once up front since the fuzzy finder asks for its text repeatedly
 #[derive(Debug)]
 struct TestCase {
-    name: String,
-    file: PathBuf,
-    class_name: Option<String>,
+    /// pytest identifier for the test, e.g. `path/test_foo.py::TestFoo::test_bar`
+    rendered: String,
+}
+
+impl TestCase {
+    fn new(name: &str, file: &Path, class_name: Option<&str>) -> Self {
+        let mut rendered = String::new();
+        write_test_id(&mut rendered, file, class_name, name);
+        Self { rendered }
+    }
+}
+
+/// Append the pytest identifier for a test to `out`
+fn write_test_id(out: &mut String, file: &Path, class_name: Option<&str>, name: &str) {
+    // formatting into a String cannot fail
+    let _ = if let Some(class_name) = class_name {
+        write!(out, "{}::{}::{}", file.display(), class_name, name)
+    } else {
+        write!(out, "{}::{}", file.display(), name)
+    };
 }
 
 impl skim::SkimItem for TestCase {
     fn text(&self) -> std::borrow::Cow<str> {
-        Cow::Owned(format!("{self}"))
+        Cow::Borrowed(&self.rendered)
     }
 }
 
 impl fmt::Display for TestCase {
     fn fmt(&self, f: &mut fmt::Formatter<'_>) -> fmt::Result {
-        if let Some(class_name) = &self.class_name {
-            f.write_str(&format!(
-                "{}::{}::{}",
-                self.file.display(),
-                class_name,
-                self.name
-            ))
-        } else {
-            f.write_str(&format!("{}::{}", self.file.display(), self.name))
+        f.write_str(&self.rendered)
+    }
+}
+
+#[cfg(test)]
+mod tests {
+    use super::*;
+
+    /// Check that both parsers find the expected tests in `source`
+    #[track_caller]
+    fn check(source: &str, expected: &[(Option<&str>, &[&str])]) {
+        let expected: FileTests = expected
+            .iter()
+            .map(|(class_name, names)| {
+                (
+                    class_name.map(str::to_string),
+                    names.iter().map(|name| name.to_string()).collect(),
+                )
+            })
+            .collect();
+
+        let mut scanned = Visitor::new(source.as_bytes());
+        scanned.scan().unwrap();
+        assert_eq!(scanned.tests, expected, "scanned tests");
+
+        let mut visited = Visitor::new(source.as_bytes());
+        visited.visit().unwrap();
+        assert_eq!(visited.tests, expected, "parsed tests");
+    }
+
+    #[test]
+    fn module_level_functions() {
+        let source = r#"
+import pytest
+
+def helper():
+    pass
+
+def test_a():
+    pass
+
+async def test_b():
+    pass
+"#;
+        check(source, &[(None, &["test_a", "test_b"])]);
+    }
+
+    #[test]
+    fn prefilter() {
+        assert!(may_contain_tests(b"def test_a():\n"));
+        assert!(may_contain_tests(
+            b"class TestFoo:\n    def\ttest_a(self):\n"
+        ));
+        assert!(may_contain_tests(b"async def  test_a():\n"));
+        assert!(!may_contain_tests(
+            b"from conftest_utils import test_data\n"
+        ));
+        assert!(!may_contain_tests(b"def helper(test_data):\n"));
+        check("def\ttest_a():\n    pass\n", &[(None, &["test_a"])]);
+    }
+
+    #[test]
+    fn class_methods() {
+        let source = r#"
+class TestFoo:
+    def test_a(self):
+        pass
+
+    def helper(self):
+        pass
+
+class Helper:
+    def test_b(self):
+        pass
+"#;
+        check(source, &[(Some("TestFoo"), &["test_a"])]);
+    }
+
+    #[test]
+    fn multi_line_class_header() {
+        let black = r#"
+class TestFoo(
+    Base,
+):
+    def test_a(self):
+        pass
+
+    @pytest.mark.asyncio
+    async def test_b(self):
+        pass
+"#;
+        check(black, &[(Some("TestFoo"), &["test_a", "test_b"])]);
+
+        let aligned = r#"
+class TestFoo(Base,
+              Mixin):
+    def test_a(self):
+        pass
+
+    @pytest.mark.asyncio
+    async def test_b(self):
+        pass
+"#;
+        check(aligned, &[(Some("TestFoo"), &["test_a", "test_b"])]);
+    }
+
+    #[test]
+    fn decorated_classes_and_methods() {
+        let source = r#"
+@pytest.mark.usefixtures("db")
+class TestFoo:
+    @pytest.mark.parametrize(
+        "x",
+        [1, 2],
+    )
+    def test_a(self, x):
+        pass
+
+    @staticmethod
+    def test_b():
+        pass
+"#;
+        check(source, &[(Some("TestFoo"), &["test_a", "test_b"])]);
+    }
+
+    #[test]
+    fn multi_line_signatures() {
+        let source = r#"
+def test_a(
+    a,
+    b,
+):
+    pass
+
+class TestFoo:
+    def test_b(
+        self,
+    ):
+        pass
+
+    def test_c(self,
+               x):
+        pass
+
+def test_d(a, \
+           b):
+    pass
+"#;
+        check(
+            source,
+            &[
+                (None, &["test_a"]),
+                (Some("TestFoo"), &["test_b", "test_c"]),
+                (None, &["test_d"]),
+            ],
+        );
+    }
+
+    #[test]
+    fn strings_and_comments() {
+        let source = r#"
+def test_a():
+    """
+def test_not_a_test():
+    """
+    x = ")"  # (
+
+class TestFoo:
+    y = '''(
+'''
+    z = r'u"a\
+de("'
+    def test_b(self):
+        pass
+"#;
+        check(
+            source,
+            &[(None, &["test_a"]), (Some("TestFoo"), &["test_b"])],
+        );
+    }
+
+    #[test]
+    fn unicode_identifiers() {
+        let source = r#"
+def test_café():
+    pass
+
+class TestÜber:
+    def test_naïve(self):
+        pass
+"#;
+        check(
+            source,
+            &[(None, &["test_café"]), (Some("TestÜber"), &["test_naïve"])],
+        );
+    }
+
+    fn cached_file(size: u64, strict: bool) -> CachedFile {
+        CachedFile {
+            modified: SystemTime::UNIX_EPOCH,
+            size,
+            strict,
+            tests: vec![(None, vec!["test_a".to_string()])],
+        }
+    }
+
+    /// A cache holding an entry for each of `paths`, which is never written to disk
+    fn test_cache(paths: &[&str]) -> TestCache {
+        TestCache {
+            persisted: PersistedTestCache {
+                files: paths
+                    .iter()
+                    .map(|path| (PathBuf::from(path), cached_file(1, false)))
+                    .collect(),
+                ..Default::default()
+            },
+            cache_file: PathBuf::new(),
         }
     }
+
+    fn cached_paths(cache: &TestCache) -> Vec<&str> {
+        let mut paths: Vec<_> = cache
+            .persisted
+            .files
+            .keys()
+            .map(|path| path.to_str().unwrap())
+            .collect();
+        paths.sort();
+        paths
+    }
+
+    #[test]
+    fn cache_get_requires_unchanged_file() {
+        let cache = test_cache(&["/a/test_a.py"]);
+        let path = Path::new("/a/test_a.py");
+        let modified = SystemTime::UNIX_EPOCH;
+
+        assert!(cache.get(path, modified, 1, false).is_some());
+        assert!(cache
+            .get(path, modified + std::time::Duration::from_secs(1), 1, false)
+            .is_none());
+        assert!(cache.get(path, modified, 2, false).is_none());
+        assert!(cache.get(path, modified, 1, true).is_none());
+        assert!(cache
+            .get(Path::new("/a/test_b.py"), modified, 1, false)
+            .is_none());
+    }
+
+    #[test]
+    fn cache_update_evicts_unvisited_files_under_roots() {
+        let mut cache = test_cache(&[
+            "/a/test_kept.py",
+            "/a/sub/test_deleted.py",
+            "/ab/test_sibling.py",
+            "/b/test_other.py",
+        ]);
+
+        let changed = cache.update(
+            &[PathBuf::from("/a")],
+            vec![(PathBuf::from("/a/test_kept.py"), None)],
+        );
+
+        assert!(changed);
+        assert_eq!(
+            cached_paths(&cache),
+            ["/a/test_kept.py", "/ab/test_sibling.py", "/b/test_other.py"]
+        );
+    }
+
+    #[test]
+    fn cache_update_reports_changes() {
+        let roots = [PathBuf::from("/a")];
+        let a = PathBuf::from("/a/test_a.py");
+        let b = PathBuf::from("/a/test_b.py");
+        let mut cache = test_cache(&["/a/test_a.py"]);
+
+        // every file unchanged
+        assert!(!cache.update(&roots, vec![(a.clone(), None)]));
+
+        // a file parsed again
+        assert!(cache.update(&roots, vec![(a.clone(), Some(cached_file(2, false)))]));
+        assert_eq!(cache.persisted.files[&a].size, 2);
+
+        // a new file
+        assert!(cache.update(
+            &roots,
+            vec![(a.clone(), None), (b.clone(), Some(cached_file(1, false)))]
+        ));
+        assert_eq!(cached_paths(&cache), ["/a/test_a.py", "/a/test_b.py"]);
+
+        // a file removed
+        assert!(cache.update(&roots, vec![(b.clone(), None)]));
+        assert_eq!(cached_paths(&cache), ["/a/test_b.py"]);
+
+        // nothing left to remove
+        assert!(!cache.update(&roots, vec![(b, None)]));
+    }
+
+    #[cfg(unix)]
+    #[test]
+    fn cache_update_ignores_paths_that_are_not_utf8() {
+        use std::{ffi::OsStr, os::unix::ffi::OsStrExt};
+
+        let path = Path::new("/a").join(OsStr::from_bytes(b"test_\xff.py"));
+        let mut cache = test_cache(&[]);
+
+        assert!(!cache.update(
+            &[PathBuf::from("/a")],
+            vec![(path, Some(cached_file(1, false)))]
+        ));
+        assert!(cache.persisted.files.is_empty());
+    }
+
+    #[test]
+    fn cache_discards_other_versions() {
+        let cache_root =
+            std::env::temp_dir().join(format!("testsearch-cache-versions-{}", std::process::id()));
+        let _ = fs::remove_dir_all(&cache_root);
+        let cache_file = cache_root.join("tests.json");
+
+        let mut cache = TestCache::new(&cache_root).unwrap();
+        cache
+            .persisted
+            .files
+            .insert(PathBuf::from("/a/test_a.py"), cached_file(1, false));
+        cache.flush().unwrap();
+        let reloaded = TestCache::new(&cache_root).unwrap();
+        assert_eq!(cached_paths(&reloaded), ["/a/test_a.py"]);
+
+        // written by another version
+        cache.persisted.version = TEST_CACHE_VERSION + 1;
+        cache.flush().unwrap();
+        assert!(TestCache::new(&cache_root)
+            .unwrap()
+            .persisted
+            .files
+            .is_empty());
+
+        // written before the cache was versioned
+        let mut unversioned = serde_json::to_value(&cache.persisted).unwrap();
+        unversioned.as_object_mut().unwrap().remove("version");
+        fs::write(&cache_file, unversioned.to_string()).unwrap();
+        assert!(TestCache::new(&cache_root)
+            .unwrap()
+            .persisted
+            .files
+            .is_empty());
+
+        // not a cache at all
+        fs::write(&cache_file, "not json").unwrap();
+        assert!(TestCache::new(&cache_root)
+            .unwrap()
+            .persisted
+            .files
+            .is_empty());
+
+        fs::remove_dir_all(&cache_root).unwrap();
+    }
 }